@@ -0,0 +1,580 @@
+"""
+Non-interactive performance benchmark for array_illumination.py
+
+Generates synthetic lattice-illuminated datasets (data, lake,
+background and a hot pixel list), times lattice detection, the lake
+calibration and the Enderlein reconstruction at several process
+counts, and appends the timings to a JSON history file. Each run is
+compared against the most recent earlier run on the same host; stages
+that got noticeably slower are reported, and the exit status is
+nonzero, so the benchmark can gate a change.
+
+It also times importing the processing modules in a fresh
+interpreter, since every worker process pays that cost, and fails if
+an import is over budget or loads plotting or GUI modules.
+
+Example:
+    python benchmark.py --sizes 512 1024 --scan-types 1d 2d arbitrary \
+        --processes 1 2 4
+
+Datasets are deterministic for a given set of parameters, and are
+reused between runs. They're large, since each frame is stored
+uncompressed.
+
+Lattice detection is timed with its defaults: a batched pass that sums
+the frame FFTs into the average and absolute-value images, then
+shift-vector harmonics computed directly from the raw frames. No full
+FFT stack is cached (keep_fft_data=False). Every timing starts from a
+directory holding only the input files, plus, for the reconstruction,
+the lake and background calibration it reads.
+"""
+import os, sys, json, time, shutil, argparse, platform, subprocess
+import numpy
+import scipy
+from scipy.ndimage import gaussian_filter
+import array_illumination
+
+input_files = ('data.raw', 'lake.raw', 'background.raw',
+               'hot_pixels.txt', 'dataset.json')
+calibration_files = ('background_background_image.raw',
+                     'lake_spot_intensities.npy',
+                     'lake_spot_intensities_valid.npy',
+                     'lake_avg_intensity.pkl')
+processing_modules = ('array_illumination', 'decon')
+display_modules = ('matplotlib', 'pylab', 'Tkinter', '_tkinter',
+                   'tkFileDialog', 'tkSimpleDialog', 'tkMessageBox')
+
+def get_true_lattice(lattice_period=24., rotation=0.1):
+    """Three real-space lattice vectors of a hexagonal lattice, 120
+    degrees apart, summing to zero."""
+    angles = rotation + numpy.array((0, 2*numpy.pi/3))
+    v0, v1 = [lattice_period * numpy.array((numpy.cos(a), numpy.sin(a)))
+              for a in angles]
+    return [v0, v1, -(v0 + v1)]
+
+def get_true_shift_vector(
+    lattice_vectors, scan_type, scan_dimensions, step_size=1.5,
+    jitter=0.1, seed=0):
+    """A shift vector in the format get_shift() understands, which
+    scans the illumination across one unit cell of the lattice.
+
+    '2d' steps along the first lattice vector (fast axis) and
+    perpendicular to it (slow axis), like a DMD. '1d' takes equal
+    steps in one direction, wrapping around the unit cell in several
+    rows, like a Visitech scanner. 'arbitrary' visits the '2d'
+    positions in a random order, with a little position jitter."""
+    n_fast, n_slow = scan_dimensions
+    num_frames = n_fast * n_slow
+    v0, v1 = lattice_vectors[:2]
+    if scan_type == '1d':
+        rows = max(1, int(round(num_frames * step_size /
+                                numpy.sqrt((v0**2).sum()))))
+        return (rows * v0 + v1) * 1.0 / num_frames
+    unit_cell_height = abs(numpy.cross(v0, v1)) / numpy.sqrt((v0**2).sum())
+    perpendicular = numpy.dot(v0, ((0., -1.), (1., 0.)))
+    perpendicular *= numpy.sign(numpy.dot(perpendicular, v1))
+    perpendicular /= numpy.sqrt((perpendicular**2).sum())
+    raster = {'fast_axis': v0 * 1.0 / n_fast,
+              'slow_axis': perpendicular * unit_cell_height / n_slow,
+              'scan_dimensions': (n_fast, n_slow)}
+    if scan_type == '2d':
+        return raster
+    elif scan_type == 'arbitrary':
+        rng = numpy.random.RandomState(seed + 1)
+        positions = numpy.array([array_illumination.get_shift(raster, z)
+                                 for z in range(num_frames)])
+        positions = positions[rng.permutation(num_frames)]
+        positions += rng.normal(scale=jitter, size=positions.shape)
+        return list(positions - positions[0])
+    raise UserWarning("Scan type must be '1d', '2d' or 'arbitrary'")
+
+def get_test_object(shape, rng, bead_density=1e-3):
+    """A smooth, textured sample with scattered bright beads."""
+    texture = gaussian_filter(rng.standard_normal(shape), sigma=6)
+    texture = numpy.clip(texture / texture.std(), 0, None)
+    beads = 20. * (rng.random_sample(shape) < bead_density)
+    return 0.2 + texture + beads
+
+def render_illumination(padded_shape, lattice_vectors, center_pix, sigma):
+    """Gaussian illumination spots at every lattice point. Each spot
+    is splatted bilinearly onto the pixel grid, then blurred."""
+    points = numpy.array(array_illumination.generate_lattice(
+        padded_shape, lattice_vectors, center_pix=center_pix))
+    corner = numpy.floor(points).astype(int)
+    fraction = points - corner
+    indices, weights = [], []
+    for di in (0, 1):
+        for dj in (0, 1):
+            indices.append((corner[:, 0] + di) * padded_shape[1] +
+                           corner[:, 1] + dj)
+            weights.append(numpy.abs(1 - di - fraction[:, 0]) *
+                           numpy.abs(1 - dj - fraction[:, 1]))
+    splat = numpy.bincount(
+        numpy.concatenate(indices), weights=numpy.concatenate(weights),
+        minlength=padded_shape[0] * padded_shape[1])
+    return gaussian_filter(splat.reshape(padded_shape), sigma=sigma)
+
+def write_stack(filename, expected_counts, num_frames, rng):
+    """Add Poisson noise to each expected frame and save the stack as
+    16-bit raw data. 'expected_counts' is a function of the frame
+    number."""
+    data_file = open(filename, 'wb')
+    for z in range(num_frames):
+        counts = rng.poisson(expected_counts(z))
+        numpy.clip(counts, 0, 2**16 - 1).astype(numpy.uint16).tofile(
+            data_file)
+    data_file.close()
+
+def generate_dataset(
+    directory,
+    image_shape=(512, 512),
+    scan_type='2d',
+    scan_dimensions=(16, 14),
+    background_frames=50,
+    lattice_period=24.,
+    rotation=0.1,
+    step_size=1.5,
+    illumination_sigma=1.5,
+    emission_sigma=1.5,
+    brightness=400.,
+    background_level=100.,
+    num_hot_pixels=20,
+    seed=0,
+    verbose=True):
+    """Writes a synthetic MSIM dataset to 'directory', and returns a
+    dict describing it, including the true lattice parameters. An
+    existing dataset with the same parameters is reused."""
+    parameters = {
+        'image_shape': list(image_shape),
+        'scan_type': scan_type,
+        'scan_dimensions': list(scan_dimensions),
+        'background_frames': background_frames,
+        'lattice_period': lattice_period,
+        'rotation': rotation,
+        'step_size': step_size,
+        'illumination_sigma': illumination_sigma,
+        'emission_sigma': emission_sigma,
+        'brightness': brightness,
+        'background_level': background_level,
+        'num_hot_pixels': num_hot_pixels,
+        'hot_pixel_order': 'yx',
+        'seed': seed}
+    description_name = os.path.join(directory, 'dataset.json')
+    if os.path.exists(description_name):
+        description = load_dataset(directory)
+        if description['parameters'] == parameters:
+            if verbose: print "Reusing dataset in", directory
+            return description
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    if verbose: print "Generating dataset in", directory
+    start_time = time.time()
+
+    rng = numpy.random.RandomState(seed)
+    num_frames = scan_dimensions[0] * scan_dimensions[1]
+    lattice_vectors = get_true_lattice(lattice_period, rotation)
+    shift_vector = get_true_shift_vector(
+        lattice_vectors, scan_type, scan_dimensions, step_size, seed=seed)
+    offset_vector = (numpy.array(image_shape) // 2 +
+                     rng.random_sample(2) * lattice_period * 0.5)
+    padding = int(4 * (illumination_sigma + emission_sigma)) + 2
+    padded_shape = (image_shape[0] + 2*padding, image_shape[1] + 2*padding)
+    crop = (slice(padding, padding + image_shape[0]),
+            slice(padding, padding + image_shape[1]))
+    """Scale so a spot on a uniform object peaks at 'brightness'"""
+    peak_scale = brightness * 2 * numpy.pi * (
+        illumination_sigma**2 + emission_sigma**2)
+    hot_pixels = numpy.array(
+        [rng.randint(0, image_shape[0], num_hot_pixels),
+         rng.randint(0, image_shape[1], num_hot_pixels)])
+    hot_pixel_counts = numpy.zeros(image_shape)
+    hot_pixel_counts[hot_pixels[0], hot_pixels[1]] = 2000.
+    sample = get_test_object(padded_shape, rng)
+
+    def expected_counts(z, test_object=None):
+        illumination = render_illumination(
+            padded_shape, lattice_vectors,
+            center_pix=(offset_vector + padding +
+                        array_illumination.get_shift(shift_vector, z)),
+            sigma=illumination_sigma)
+        if test_object is not None:
+            illumination *= test_object
+        emission = gaussian_filter(illumination, sigma=emission_sigma)
+        return (peak_scale * emission[crop] +
+                background_level + hot_pixel_counts)
+
+    write_stack(os.path.join(directory, 'data.raw'),
+                lambda z: expected_counts(z, sample), num_frames, rng)
+    write_stack(os.path.join(directory, 'lake.raw'),
+                expected_counts, num_frames, rng)
+    write_stack(os.path.join(directory, 'background.raw'),
+                lambda z: background_level + hot_pixel_counts,
+                background_frames, rng)
+    """hot_pixels.txt holds the y coordinates, then the x coordinates;
+    hot pixel y, x lives at image[x, y]"""
+    y_then_x = numpy.vstack((hot_pixels[1], hot_pixels[0]))
+    hot_pixel_file = open(os.path.join(directory, 'hot_pixels.txt'), 'wb')
+    hot_pixel_file.write(', '.join('%i'%(p) for p in y_then_x.ravel()))
+    hot_pixel_file.close()
+    corrected = array_illumination.load_hot_pixels(
+        directory, image_shape).correct(background_level + hot_pixel_counts)
+    assert (corrected[hot_pixels[0], hot_pixels[1]] <
+            background_level + 1000).all()
+
+    description = {
+        'directory': directory,
+        'parameters': parameters,
+        'lattice_vectors': lattice_vectors,
+        'shift_vector': shift_vector,
+        'offset_vector': offset_vector}
+    description_file = open(description_name, 'wb')
+    json.dump(to_json(description), description_file, indent=1)
+    description_file.close()
+    if verbose:
+        print "Dataset generated in %0.2f seconds"%(time.time() - start_time)
+    return load_dataset(directory)
+
+def load_dataset(directory):
+    """Read back a dataset description saved by generate_dataset()."""
+    description = json.load(open(os.path.join(directory, 'dataset.json')))
+    description['directory'] = directory
+    description['lattice_vectors'] = [
+        numpy.array(v) for v in description['lattice_vectors']]
+    description['offset_vector'] = numpy.array(description['offset_vector'])
+    shift_vector = description['shift_vector']
+    if isinstance(shift_vector, dict):
+        shift_vector['fast_axis'] = numpy.array(shift_vector['fast_axis'])
+        shift_vector['slow_axis'] = numpy.array(shift_vector['slow_axis'])
+        shift_vector['scan_dimensions'] = tuple(
+            shift_vector['scan_dimensions'])
+    elif len(numpy.shape(shift_vector)) == 2:
+        shift_vector = [numpy.array(s) for s in shift_vector]
+    else:
+        shift_vector = numpy.array(shift_vector)
+    description['shift_vector'] = shift_vector
+    return description
+
+def to_json(x):
+    """Convert numpy arrays and scalars nested in dicts and lists into
+    something json can store."""
+    if isinstance(x, dict):
+        return dict((str(k), to_json(v)) for k, v in x.items())
+    elif isinstance(x, (list, tuple)):
+        return [to_json(v) for v in x]
+    elif isinstance(x, numpy.ndarray):
+        return x.tolist()
+    elif isinstance(x, numpy.generic):
+        return x.item()
+    return x
+
+def clear_cache(directory, keep=input_files):
+    """Delete everything but the files in 'keep' (by default, the input
+    files), so every timing starts from cold caches."""
+    for name in os.listdir(directory):
+        if name in keep:
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+def position_error(dataset, lattice_vectors, shift_vector, offset_vector):
+    """The worst-case distance, over all frames, between the true and
+    the detected position of the illumination lattice, modulo the
+    lattice. Also returns the worst lattice vector error."""
+    true_vectors = dataset['lattice_vectors']
+    vector_error = max(
+        min(numpy.sqrt(((s*v - t)**2).sum())
+            for v in lattice_vectors for s in (1, -1))
+        for t in true_vectors)
+    basis = numpy.vstack(true_vectors[:2]).T
+    num_frames = numpy.prod(dataset['parameters']['scan_dimensions'])
+    worst = 0
+    for z in range(num_frames):
+        difference = (
+            offset_vector + array_illumination.get_shift(shift_vector, z) -
+            dataset['offset_vector'] -
+            array_illumination.get_shift(dataset['shift_vector'], z))
+        components = numpy.linalg.solve(basis, difference)
+        residual = numpy.dot(basis, components - numpy.round(components))
+        """The nearest lattice point may be a neighbor of the rounded one"""
+        residual = min((residual - numpy.dot(basis, (a, b))
+                        for a in (-1, 0, 1) for b in (-1, 0, 1)),
+                       key=lambda r: (r**2).sum())
+        worst = max(worst, numpy.sqrt((residual**2).sum()))
+    return worst, vector_error
+
+def time_call(function, repeats, before=None, **kwargs):
+    """Best-of-'repeats' wall-clock time of function(**kwargs). 'before'
+    runs ahead of each repeat, untimed."""
+    best = None
+    for r in range(repeats):
+        if before is not None:
+            before()
+        start_time = time.time()
+        result = function(**kwargs)
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def benchmark_dataset(
+    dataset, process_counts=(1,), repeats=1, extent=None, verbose=False):
+    """Times lattice detection once, then the lake calibration and the
+    reconstruction at each process count. Calibration and
+    reconstruction use the true lattice parameters, so their workload
+    doesn't depend on the detection."""
+    directory = dataset['directory']
+    p = dataset['parameters']
+    xPix, yPix = p['image_shape']
+    zPix = p['scan_dimensions'][0] * p['scan_dimensions'][1]
+    data, lake, background = [
+        os.path.join(directory, n) for n in input_files[:3]]
+    if extent is None:
+        """Smaller than the spacing of the Fourier lattice"""
+        extent = int(0.6 * min(xPix, yPix) / p['lattice_period'])
+    results = {}
+
+    print "\nDetecting lattice:", directory
+    try:
+        seconds, (lattice_vectors, shift_vector, offset_vector
+                  ) = time_call(
+                      array_illumination.get_lattice_vectors, repeats,
+                      before=lambda: clear_cache(directory),
+                      filename_list=[data], xPix=xPix, yPix=yPix,
+                      zPix=zPix, extent=extent,
+                      scan_type=p['scan_type'],
+                      scan_dimensions=p['scan_dimensions'],
+                      verbose=verbose, display=False,
+                      record_parameters=False)
+        results['get_lattice_vectors'] = seconds
+        (results['lattice_position_error'], results['lattice_vector_error']
+         ) = position_error(dataset, lattice_vectors, shift_vector,
+                            offset_vector)
+        print " %0.2f s, lattice position error %0.3f pixels"%(
+            seconds, results['lattice_position_error'])
+    except UserWarning as error:
+        print " Lattice detection failed:", error
+        results['lattice_detection_failed'] = str(error)
+
+    lattice_vectors = dataset['lattice_vectors']
+    shift_vector = dataset['shift_vector']
+    offset_vector = dataset['offset_vector']
+    for n in process_counts:
+        print "\nCalibrating, %i process(es):"%(n), directory
+        seconds, calibration = time_call(
+            array_illumination.spot_intensity_vs_scan_position, repeats,
+            before=lambda: clear_cache(directory),
+            lake_filename=lake, xPix=xPix, yPix=yPix, zPix=zPix, preframes=0,
+            direct_lattice_vectors=lattice_vectors,
+            shift_vector=shift_vector, offset_vector=offset_vector,
+            background_filename=background,
+            background_zPix=p['background_frames'],
+            verbose=verbose, num_processes=n)
+        results['spot_intensity_vs_scan_position/%i'%(n)] = seconds
+        print " %0.2f s"%(seconds)
+
+        print "\nReconstructing, %i process(es):"%(n), directory
+        seconds, images = time_call(
+            array_illumination.enderlein_image_parallel, repeats,
+            before=lambda: clear_cache(
+                directory, keep=input_files + calibration_files),
+            data_filename=data, lake_filename=lake,
+            background_filename=background,
+            xPix=xPix, yPix=yPix, zPix=zPix, steps=zPix, preframes=0,
+            lattice_vectors=lattice_vectors, offset_vector=offset_vector,
+            shift_vector=shift_vector,
+            new_grid_xrange=(0, xPix-1, 2*xPix),
+            new_grid_yrange=(0, yPix-1, 2*yPix),
+            num_processes=n, verbose=verbose)
+        results['enderlein_image_parallel/%i'%(n)] = seconds
+        print " %0.2f s"%(seconds)
+    clear_cache(directory)
+    return results
+
+def measure_import_time(module_name, repeats=3):
+    """Best-of-'repeats' time to import 'module_name' in a fresh
+    interpreter, and the plotting or GUI modules the import loaded."""
+    code = (
+        "import sys, time, json\n"
+        "start_time = time.time()\n"
+        "import %s\n"
+        "elapsed = time.time() - start_time\n"
+        "print json.dumps([elapsed, sorted(set(\n"
+        "    m.split('.')[0] for m in sys.modules\n"
+        "    if m.split('.')[0] in %r and sys.modules[m] is not None))])\n"
+        )%(module_name, display_modules)
+    best = None
+    for r in range(repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed, loaded = json.loads(output.splitlines()[-1])
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, loaded
+
+def check_imports(budget=1.0, repeats=3):
+    """Time importing each processing module. Returns the timings
+    and a list of problems: failed imports, imports over 'budget'
+    seconds, and imports that load plotting or GUI modules."""
+    results, problems = {}, []
+    for module_name in processing_modules:
+        try:
+            seconds, loaded = measure_import_time(module_name, repeats)
+        except subprocess.CalledProcessError:
+            problems.append("import %s failed"%(module_name))
+            results[module_name] = 'failed'
+            continue
+        results[module_name] = seconds
+        print "Importing %s: %0.3f s"%(module_name, seconds)
+        if seconds > budget:
+            problems.append("import %s took %0.3f s, over the %0.3f s budget"%(
+                module_name, seconds, budget))
+        if loaded:
+            problems.append("import %s loads %s"%(
+                module_name, ', '.join(loaded)))
+    return results, problems
+
+def get_version():
+    """'git describe' of the source tree, if it's a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'wb')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def load_history(history_filename):
+    if not os.path.exists(history_filename):
+        return []
+    return json.load(open(history_filename))
+
+def save_history(history_filename, history):
+    """Written to a temporary file first, so an interrupted benchmark
+    can't corrupt the history."""
+    temporary_name = history_filename + '.tmp'
+    history_file = open(temporary_name, 'wb')
+    json.dump(history, history_file, indent=1, sort_keys=True)
+    history_file.close()
+    array_illumination.replace_file(temporary_name, history_filename)
+
+def find_regressions(history, record, threshold=1.25, min_seconds=0.5):
+    """Compare 'record' against the most recent earlier record from the
+    same host. A stage regresses if it got slower by more than a factor
+    of 'threshold' and by more than 'min_seconds'. Returns the earlier
+    record (or None) and a list of (case, stage, old, new) regressions."""
+    previous = None
+    for old in reversed(history):
+        if old['host'] == record['host']:
+            previous = old
+            break
+    if previous is None:
+        return None, []
+    regressions = []
+    for case, timings in sorted(record['results'].items()):
+        old_timings = previous['results'].get(case, {})
+        for stage, new in sorted(timings.items()):
+            old = old_timings.get(stage)
+            if not (isinstance(new, float) and isinstance(old, float)):
+                continue
+            if stage.startswith('lattice_'): #Accuracy, not speed
+                continue
+            if new > threshold * old and new - old > min_seconds:
+                regressions.append((case, stage, old, new))
+    return previous, regressions
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark array_illumination.py on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512],
+                        help='Image sizes in pixels (square images)')
+    parser.add_argument('--scan-types', nargs='+', default=['2d'],
+                        choices=['1d', '2d', 'arbitrary'])
+    parser.add_argument('--scan-dimensions', type=int, nargs=2,
+                        default=[16, 14], metavar=('FAST', 'SLOW'))
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='Report the best of this many runs')
+    parser.add_argument('--extent', type=int, default=None,
+                        help='Spike search extent for lattice detection')
+    parser.add_argument('--directory', default='benchmark_data',
+                        help='Where to put the synthetic datasets')
+    parser.add_argument('--history', default=None,
+                        help='JSON history file [DIRECTORY/history.json]')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown factor that counts as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help='Ignore slowdowns smaller than this')
+    parser.add_argument('--import-budget', type=float, default=1.0,
+                        help='Seconds allowed to import a processing module')
+    parser.add_argument('--imports-only', action='store_true',
+                        help='Only check import times')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(arguments)
+    if args.history is None:
+        args.history = os.path.join(args.directory, 'history.json')
+
+    record = {
+        'version': get_version(),
+        'recorded': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'cpu_count': array_illumination.mp.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'scipy': scipy.__version__,
+        'results': {}}
+    record['results']['import'], problems = check_imports(args.import_budget)
+    if args.imports_only:
+        args.sizes = []
+    for size in args.sizes:
+        for scan_type in args.scan_types:
+            case = '%ix%i_%s'%(size, size, scan_type)
+            dataset = generate_dataset(
+                os.path.join(args.directory, case),
+                image_shape=(size, size), scan_type=scan_type,
+                scan_dimensions=args.scan_dimensions, seed=args.seed)
+            record['results'][case] = benchmark_dataset(
+                dataset, process_counts=args.processes,
+                repeats=args.repeats, extent=args.extent,
+                verbose=args.verbose)
+
+    history = load_history(args.history)
+    previous, regressions = find_regressions(
+        history, record, args.threshold, args.min_seconds)
+    history.append(record)
+    save_history(args.history, history)
+
+    print "\nResults (seconds):"
+    for case, timings in sorted(record['results'].items()):
+        print case
+        for stage, value in sorted(timings.items()):
+            if isinstance(value, float):
+                print "  %-36s %10.3f"%(stage, value)
+            else:
+                print "  %-36s %s"%(stage, value)
+    print "Saved to", args.history
+    if problems:
+        print "IMPORT PROBLEMS:"
+        for p in problems:
+            print " ", p
+    if previous is None:
+        print "No earlier run from this host to compare against."
+        return int(bool(problems))
+    print "Compared against", previous['version'], previous['recorded']
+    if not regressions:
+        print "No regressions."
+        return int(bool(problems))
+    print "REGRESSIONS:"
+    for case, stage, old, new in regressions:
+        print "  %s %s: %0.3f s -> %0.3f s (%0.2fx)"%(
+            case, stage, old, new, new / old)
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,5 @@
 import os, sys, time, ConfigParser
 import numpy
-import Tkinter as Tk, tkFileDialog, tkSimpleDialog
 from scipy.ndimage import gaussian_filter, center_of_mass
 from scipy.fftpack import fftn, ifftn, fftshift
 from simple_tif import tif_to_array, array_to_tif
@@ -47,7 +46,10 @@ def richardson_lucy_deconvolution(
     Select and load image data.
     """
 
-    if tk_master is None:
+    if tk_master is None and (image_data is None or psf_data is None or
+                              psf_sigma is None or num_iterations is None):
+        """Only the dialogs need Tk, so batch use can run headless"""
+        import Tkinter as Tk
         tk_master = Tk.Tk()
         tk_master.withdraw()
 
@@ -110,6 +112,7 @@ def richardson_lucy_deconvolution(
             initial_value = int(config.get('File', 'last_num_iterations'))
         except:
             initial_value = 10
+        import tkSimpleDialog
         num_iterations = tkSimpleDialog.askinteger(
             title="Iterations",
             prompt="How many deconvolution iterations?",
@@ -236,6 +239,7 @@ def image_data_as_array(
     ):
 
     if image_data is None:
+        import Tkinter as Tk, tkFileDialog
         if master is None:
             root = Tk.Tk()
             root.withdraw()
@@ -358,6 +362,7 @@ def get_image_info(image_filename, config=None, master=None):
 class ImageInfoDialog:
     def __init__(self, image_filename, master=None,
                  initial_shape=('0', '0'), initial_dtype='uint16'):
+        import Tkinter as Tk
         if master is None:
             self.master = Tk.Tk()
             self.master.withdraw()
@@ -466,6 +471,7 @@ def ask_psf_type(config=None, master=None):
 
 class PsfTypeDialog:
     def __init__(self, initial_type, master=None):
+        import Tkinter as Tk
         if master is None:
             self.master = Tk.Tk()
             self.master.withdraw()
@@ -541,6 +547,7 @@ def ask_psf_sigma(config=None, master=None):
 
 class PsfFwhmDialog:
     def __init__(self, initial_fwhm, master=None):
+        import Tkinter as Tk
         if master is None:
             self.master = Tk.Tk()
             self.master.withdraw()
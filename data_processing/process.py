@@ -21,6 +21,8 @@ print "Background source:", background_filename
 
 use_all_lake_parameters = array_illumination.use_lake_parameters()
 
+num_processes = 6
+
 """Find a set of shift vectors which characterize the illumination"""
 print "\nDetecting illumination lattice parameters..."
 (lattice_vectors, shift_vector, offset_vector,
@@ -45,7 +47,8 @@ print "\nDetecting illumination lattice parameters..."
      animate=animate, #Useful to see if 'extent' is right
      show_interpolation=False, #Fairly low-level debugging
      show_calibration_steps=False, #Useful for debugging
-     show_lattice=True) #Very useful for checking validity
+     show_lattice=True, #Very useful for checking validity
+     num_processes=num_processes)
 print "Lattice vectors:"
 for v in lattice_vectors:
     print v
@@ -58,46 +61,33 @@ print offset_vector
 new_grid_xrange = 0, xPix-1, 2*xPix
 new_grid_yrange = 0, yPix-1, 2*yPix
 
-num_processes = 6
-for f in data_filenames_list:
-    print
-    print f
-    def profile_me():
-        array_illumination.enderlein_image_parallel(
-            data_filename=f,
-            lake_filename=lake_filename,
-            background_filename=background_filename,
-            xPix=xPix, yPix=yPix, zPix=zPix, steps=steps, preframes=preframes,
-            lattice_vectors=lattice_vectors,
-            offset_vector=offset_vector,
-            shift_vector=shift_vector,
-            new_grid_xrange=new_grid_xrange, new_grid_yrange=new_grid_yrange,
-            num_processes = num_processes,
-            window_footprint=10,
-            aperture_size=3,
-            make_widefield_image=True,
-            make_confocal_image=False, #Broken, for now
-            verbose=True,
-            show_steps=False, #For debugging
-            show_slices=False, #For debugging
-            intermediate_data=False, #Memory hog, leave 'False'
-            normalize=False, #Of uncertain merit, leave 'False' probably
-            display=False
-            )
-    if num_processes == 1:
-        import cProfile
-        cProfile.run('profile_me()', 'profile_results')
-        try:
-            import pstats
-            p = pstats.Stats('profile_results')
-            p.strip_dirs().sort_stats(-1).print_stats()
-            p.sort_stats('cumulative').print_stats(20)
-        except ImportError:
-            pass
-    else:
-        profile_me()
-
-array_illumination.join_enderlein_images(
-    data_filenames_list,
-    new_grid_xrange, new_grid_yrange,
-    join_widefield_images=False)
+def profile_me():
+    array_illumination.enderlein_image_stack(
+        data_filenames_list=data_filenames_list,
+        lake_filename=lake_filename,
+        background_filename=background_filename,
+        xPix=xPix, yPix=yPix, zPix=zPix, steps=steps, preframes=preframes,
+        lattice_vectors=lattice_vectors,
+        offset_vector=offset_vector,
+        shift_vector=shift_vector,
+        new_grid_xrange=new_grid_xrange, new_grid_yrange=new_grid_yrange,
+        num_processes=num_processes,
+        files_in_flight=2,
+        window_footprint=10,
+        aperture_size=3,
+        make_widefield_image=True,
+        verbose=True,
+        normalize=False, #Of uncertain merit, leave 'False' probably
+        )
+if num_processes == 1:
+    import cProfile
+    cProfile.run('profile_me()', 'profile_results')
+    try:
+        import pstats
+        p = pstats.Stats('profile_results')
+        p.strip_dirs().sort_stats(-1).print_stats()
+        p.sort_stats('cumulative').print_stats(20)
+    except ImportError:
+        pass
+else:
+    profile_me()
@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import ctypes
@@ -15,6 +16,17 @@ try:
     from camera_child_process import camera_child_process
 except ImportError:
     camera_child_process = None
+try:
+    import array_illumination
+except ImportError:
+    """Not on the path; look in our sibling data_processing directory"""
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        os.pardir, 'data_processing'))
+    try:
+        import array_illumination
+    except ImportError:
+        array_illumination = None
 
 """
 Acquiring and displaying data from a camera is a common problem our
@@ -36,10 +48,19 @@ class Image_Data_Pipeline:
         self,
         num_buffers=100,
         buffer_shape=(60, 256, 512),
+        live_enderlein=False,
         ):
         """
         Allocate a bunch of 16-bit buffers for image data, and a few
         8-bit buffers for display data.
+
+        If 'live_enderlein' is True, the pipeline also includes an
+        Enderlein (MSIM pixel reassignment) reconstruction stage, which
+        does nothing until it's given a lattice calibration with
+        set_enderlein_settings(). This needs array_illumination.py,
+        either importable or in the data_processing directory next to
+        this one, plus its scipy dependencies; otherwise
+        'live_enderlein' is ignored, with a printed warning.
         """
         self.buffer_shape = buffer_shape
         self.buffer_size = int(np.prod(buffer_shape))
@@ -68,9 +89,21 @@ class Image_Data_Pipeline:
             data_buffers=self.data_buffers, buffer_shape=self.buffer_shape,
             accumulation_buffers=self.accumulation_buffers,
             input_queue=self.camera.output_queue)
+        if live_enderlein and array_illumination is None:
+            print "Couldn't load array_illumination.py (from data_processing)."
+            print "No live Enderlein reconstruction."
+            live_enderlein = False
+        if live_enderlein:
+            self.enderlein = Data_Pipeline_Enderlein(
+                data_buffers=self.data_buffers, buffer_shape=self.buffer_shape,
+                input_queue=self.accumulation.output_queue)
+            file_saving_input_queue = self.enderlein.output_queue
+        else:
+            self.enderlein = None
+            file_saving_input_queue = self.accumulation.output_queue
         self.file_saving = Data_Pipeline_File_Saving(
             data_buffers=self.data_buffers, buffer_shape=self.buffer_shape,
-            input_queue=self.accumulation.output_queue)
+            input_queue=file_saving_input_queue)
         
         self.projection = Data_Pipeline_Projection(
             buffer_shape=self.buffer_shape,
@@ -157,9 +190,12 @@ class Image_Data_Pipeline:
             time.sleep(0.01)
         for p in (self.camera,
                   self.accumulation,
+                  self.enderlein,
                   self.file_saving,
                   self.projection,
                   self.display):
+            if p is None:
+                continue
             p.commands.send(('set_buffer_shape', {'shape': buffer_shape}))
             while True:
                 if p.commands.poll():
@@ -180,22 +216,63 @@ class Image_Data_Pipeline:
     def withdraw_display(self):
         self.display.commands.send(('withdraw', {}))
 
+    def set_enderlein_settings(self, settings):
+        """
+        'settings' is None (stop reconstructing), or a dict of
+        arguments to array_illumination.get_reconstruction_context()
+        and array_illumination.enderlein_image_from_frames(): at least
+        'lake_filename', 'background_filename', 'lattice_vectors',
+        'offset_vector', 'shift_vector', 'new_grid_xrange' and
+        'new_grid_yrange'. The image dimensions come from the buffer
+        shape; each buffer should hold one complete scan.
+        """
+        if self.enderlein is None:
+            raise UserWarning("This Image_Data_Pipeline was created without" +
+                              " live Enderlein reconstruction.")
+        self.enderlein.commands.send(('set_enderlein_settings',
+                                      {'settings': settings}))
+        return self.enderlein.commands.recv()
+
+    def get_enderlein_image(self):
+        """
+        The newest live reconstruction nobody's collected yet: a dict
+        of images, plus the number of buffers skipped so far because
+        reconstruction fell behind. None, if there's nothing new.
+        """
+        if self.enderlein is None:
+            return None
+        return self.enderlein.get_result()
+
     def check_children(self):
-        return {'Camera': self.camera.child.is_alive(),
-                'Accumulation': self.accumulation.child.is_alive(),
-                'File Saving': self.file_saving.child.is_alive(),
-                'Projection': self.projection.child.is_alive(),
-                'Display': self.display.child.is_alive()}
+        children = {'Camera': self.camera.child.is_alive(),
+                    'Accumulation': self.accumulation.child.is_alive(),
+                    'File Saving': self.file_saving.child.is_alive(),
+                    'Projection': self.projection.child.is_alive(),
+                    'Display': self.display.child.is_alive()}
+        if self.enderlein is not None:
+            children['Enderlein'] = self.enderlein.child.is_alive()
+            children['Enderlein Reconstruction'] = (
+                self.enderlein.reconstruction_child.is_alive())
+        return children
 
     def close(self):
         self.camera.input_queue.put(None)
         self.accumulation.input_queue.put(None)
+        if self.enderlein is not None:
+            self.enderlein.input_queue.put(None)
         self.file_saving.input_queue.put(None)
         self.projection.display_buffer_input_queue.put(None)
         self.projection.accumulation_buffer_input_queue.put(None)
         self.display.display_buffer_input_queue.put(None)
         self.camera.child.join()
         self.accumulation.child.join()
+        if self.enderlein is not None:
+            self.enderlein.child.join()
+            """The reconstruction child can't exit while its last,
+            uncollected result is stuck in the result queue's pipe"""
+            while self.enderlein.reconstruction_child.is_alive():
+                self.enderlein.get_result()
+                self.enderlein.reconstruction_child.join(0.1)
         self.file_saving.child.join()
         self.projection.child.join()
         self.display.child.join()
@@ -377,6 +454,204 @@ def accumulation_child_process(
             info("end buffer %i"%(process_me))
     return None
 
+class Data_Pipeline_Enderlein:
+    """
+    Live MSIM reconstruction. The Enderlein child passes every data
+    buffer straight through, but if a staging buffer is free, it copies
+    the data into it first, and hands the copy to the reconstruction
+    child. Reconstruction is much slower than acquisition; when it
+    falls behind, buffers go through without being copied, so the
+    camera never waits on it.
+    """
+    def __init__(
+        self,
+        data_buffers,
+        buffer_shape,
+        input_queue=None,
+        output_queue=None,
+        num_staging_buffers=2,
+        ):
+        if input_queue is None:
+            self.input_queue = mp.Queue()
+        else:
+            self.input_queue = input_queue
+
+        if output_queue is None:
+            self.output_queue = mp.Queue()
+        else:
+            self.output_queue = output_queue
+
+        self.commands, self.child_commands = mp.Pipe()
+        self.staging_buffers = [
+            mp.Array(ctypes.c_uint16, int(np.prod(buffer_shape)))
+            for b in range(num_staging_buffers)]
+        self.staging_buffer_input_queue = mp.Queue()
+        self.staging_buffer_output_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+
+        self.child = mp.Process(
+            target=enderlein_child_process,
+            args=(data_buffers, buffer_shape, self.staging_buffers,
+                  self.input_queue, self.output_queue, self.child_commands,
+                  self.staging_buffer_input_queue,
+                  self.staging_buffer_output_queue),
+            name='Enderlein')
+        self.child.start()
+        self.reconstruction_child = mp.Process(
+            target=enderlein_reconstruction_child_process,
+            args=(self.staging_buffers,
+                  self.staging_buffer_output_queue,
+                  self.staging_buffer_input_queue,
+                  self.result_queue),
+            name='Enderlein Reconstruction')
+        self.reconstruction_child.start()
+        return None
+
+    def get_result(self):
+        try:
+            return self.result_queue.get_nowait()
+        except Queue.Empty:
+            return None
+
+def enderlein_child_process(
+    data_buffers,
+    buffer_shape,
+    staging_buffers,
+    data_buffer_input_queue,
+    data_buffer_output_queue,
+    commands,
+    staging_buffer_input_queue,
+    staging_buffer_output_queue,
+    ):
+    buffer_size = np.prod(buffer_shape)
+    idle_staging_buffers = range(len(staging_buffers))
+    reconstructing = False
+    num_skipped = 0
+    while True:
+        if commands.poll():
+            cmd, args = commands.recv()
+            if cmd == 'set_buffer_shape':
+                buffer_shape = args['shape']
+                buffer_size = np.prod(buffer_shape)
+                commands.send(buffer_shape)
+            elif cmd == 'set_enderlein_settings':
+                """Same queue as the data, so the order is preserved"""
+                staging_buffer_output_queue.put(args)
+                reconstructing = args['settings'] is not None
+                commands.send(reconstructing)
+            continue
+        while True: #Collect staging buffers the reconstruction is done with
+            try:
+                idle_staging_buffers.append(
+                    staging_buffer_input_queue.get_nowait())
+            except Queue.Empty:
+                break
+        try: #Check for a pending data buffer
+            permission_slip = data_buffer_input_queue.get_nowait()
+        except Queue.Empty:
+            time.sleep(0.001)
+            continue
+        if permission_slip is None: #Poison pill. Quit!
+            staging_buffer_output_queue.put(None)
+            break
+        process_me = permission_slip['which_buffer']
+        if reconstructing and len(idle_staging_buffers) > 0:
+            """Copy the data buffer to a staging buffer"""
+            stage_me = idle_staging_buffers.pop(0)
+            info("staging buffer %i"%(process_me))
+            with data_buffers[process_me].get_lock():
+                data = np.frombuffer(
+                    data_buffers[process_me].get_obj(),
+                    dtype=np.uint16)[:buffer_size].reshape(buffer_shape)
+                with staging_buffers[stage_me].get_lock():
+                    s_b = np.frombuffer(
+                        staging_buffers[stage_me].get_obj(),
+                        dtype=np.uint16)[:buffer_size].reshape(buffer_shape)
+                    s_b[:] = data
+            reconstruct_me = {'which_buffer': stage_me,
+                              'shape': buffer_shape,
+                              'num_skipped': num_skipped}
+            if 'file_info' in permission_slip:
+                reconstruct_me['outfile'] = (
+                    permission_slip['file_info'].get('outfile'))
+            staging_buffer_output_queue.put(reconstruct_me)
+        elif reconstructing:
+            num_skipped += 1
+            info("Reconstruction behind; skipping buffer %i"%(process_me))
+        data_buffer_output_queue.put(permission_slip)
+    return None
+
+def enderlein_reconstruction_child_process(
+    staging_buffers,
+    input_queue,
+    output_queue,
+    result_queue,
+    ):
+    settings = None
+    context, context_shape = None, None
+    while True:
+        try:
+            reconstruct_me = input_queue.get_nowait()
+        except Queue.Empty:
+            time.sleep(0.001)
+            continue
+        if reconstruct_me is None: #Poison pill. Quit!
+            break
+        if 'settings' in reconstruct_me:
+            settings = reconstruct_me['settings']
+            context = None
+            continue
+        stage_me = reconstruct_me['which_buffer']
+        buffer_shape = reconstruct_me['shape']
+        if settings is None:
+            output_queue.put(stage_me)
+            continue
+        if context is None or context_shape != buffer_shape:
+            """The calibration only needs loading once per buffer shape"""
+            info("Loading Enderlein calibration")
+            context_arguments = (
+                array_illumination.reconstruction_context_arguments(settings))
+            context_arguments.update({
+                'data_filename': None,
+                'xPix': buffer_shape[1], 'yPix': buffer_shape[2],
+                'zPix': buffer_shape[0], 'steps': buffer_shape[0],
+                'preframes': 0,
+                'laser_intensity_drift_correction': False,
+                'precomputed_operator': False,
+                'verbose': False, 'display': False})
+            context = array_illumination.get_reconstruction_context(
+                **context_arguments)
+            context_shape = buffer_shape
+        info("start reconstruction of staging buffer %i"%(stage_me))
+        buffer_size = np.prod(buffer_shape)
+        with staging_buffers[stage_me].get_lock():
+            frames = np.frombuffer(
+                staging_buffers[stage_me].get_obj(),
+                dtype=np.uint16)[:buffer_size].reshape(buffer_shape)
+            images = array_illumination.enderlein_image_from_frames(
+                frames=frames, context=context,
+                lattice_vectors=settings['lattice_vectors'],
+                offset_vector=settings['offset_vector'],
+                shift_vector=settings['shift_vector'],
+                window_footprint=settings.get('window_footprint', 10),
+                scale_factor=settings.get('scale_factor', 0.5),
+                make_widefield_image=settings.get(
+                    'make_widefield_image', True),
+                dtype=settings.get('dtype', np.float32))
+        output_queue.put(stage_me)
+        info("end reconstruction of staging buffer %i"%(stage_me))
+        if reconstruct_me.get('outfile') is not None:
+            """Save next to the raw data, named like offline results"""
+            array_illumination.save_enderlein_images(
+                os.path.splitext(reconstruct_me['outfile'])[0], images)
+        images['num_skipped'] = reconstruct_me['num_skipped']
+        try: #Only the newest result is worth keeping
+            result_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        result_queue.put(images)
+    return None
+
 class Data_Pipeline_Projection:
     def __init__(
         self,